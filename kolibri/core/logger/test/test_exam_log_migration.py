@@ -5,14 +5,20 @@ from __future__ import unicode_literals
 from datetime import timedelta
 from uuid import uuid4
 
+import mock
+from django.db import connection
+from django.db.models import Min
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 
 from kolibri.core.auth.test.test_api import FacilityFactory
 from kolibri.core.auth.test.test_api import FacilityUserFactory
 from kolibri.core.exams.models import Exam
 from kolibri.core.logger import models
+from kolibri.core.logger.utils.exam_log_migration import _update_session_logs
 from kolibri.core.logger.utils.exam_log_migration import migrate_from_exam_logs
+from kolibri.utils.conf import OPTIONS
 
 
 class SimpleForwardMigrateTestCase(TestCase):
@@ -47,6 +53,7 @@ class SimpleForwardMigrateTestCase(TestCase):
         self.assertEqual(models.MasteryLog.objects.filter(complete=False).count(), 3)
         for log in models.MasteryLog.objects.all():
             self.assertTrue(log.mastery_criterion["coach_assigned"])
+            self.assertEqual(log.mastery_level, int(str(int(self.exam.id, 16))[-9:]))
 
     def test_attemptlogs(self):
         self.assertEqual(models.AttemptLog.objects.all().count(), 12)
@@ -65,6 +72,26 @@ class SimpleForwardMigrateTestCase(TestCase):
             3,
         )
 
+    def test_log_ids_match_calculate_uuid(self):
+        for LogModel in (
+            models.ContentSessionLog,
+            models.ContentSummaryLog,
+            models.MasteryLog,
+            models.AttemptLog,
+        ):
+            for log in LogModel.objects.all():
+                self.assertEqual(log.id, log.calculate_uuid())
+                self.assertEqual(log._morango_partition, log.calculate_partition())
+
+    def test_contentsessionlogs_start_timestamp(self):
+        for log in models.ContentSessionLog.objects.all():
+            self.assertEqual(
+                log.start_timestamp,
+                models.ExamAttemptLog.objects.filter(user=log.user).aggregate(
+                    start=Min("start_timestamp")
+                )["start"],
+            )
+
     def test_contentsummarylogs(self):
         self.assertEqual(
             models.ContentSummaryLog.objects.all().count(),
@@ -76,6 +103,72 @@ class SimpleForwardMigrateTestCase(TestCase):
         )
 
 
+class BatchedForwardMigrateTestCase(SimpleForwardMigrateTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        with mock.patch.dict(OPTIONS["Database"], {"EXAM_MIGRATION_BATCH_SIZE": 2}):
+            super(BatchedForwardMigrateTestCase, cls).setUpTestData()
+
+
+class BatchSizeForwardMigrateTestCase(TestCase):
+    def setUp(self):
+        facility = FacilityFactory.create()
+        coach = FacilityUserFactory.create(facility=facility)
+        exam = Exam.objects.create(
+            title="quiz", question_count=5, collection=facility, creator=coach
+        )
+        for i in range(0, 3):
+            user = FacilityUserFactory.create(facility=facility)
+            examlog = models.ExamLog.objects.create(user=user, exam=exam)
+            for j in range(0, 4):
+                models.ExamAttemptLog.objects.create(
+                    item=str(j),
+                    user=user,
+                    examlog=examlog,
+                    start_timestamp=now(),
+                    end_timestamp=now(),
+                    correct=j % 2,
+                    content_id=uuid4().hex,
+                )
+
+    def test_batch_size_below_one(self):
+        for batch_size in (0, -1):
+            # Deleting these deletes the MasteryLogs and AttemptLogs along with them
+            models.ContentSessionLog.objects.all().delete()
+            models.ContentSummaryLog.objects.all().delete()
+            with mock.patch.dict(
+                OPTIONS["Database"], {"EXAM_MIGRATION_BATCH_SIZE": batch_size}
+            ):
+                migrate_from_exam_logs(models.ExamLog.objects.all())
+            self.assertEqual(models.MasteryLog.objects.all().count(), 3)
+            self.assertEqual(models.AttemptLog.objects.all().count(), 12)
+
+    def test_batch_size_above_query_variables(self):
+        with mock.patch.dict(
+            OPTIONS["Database"], {"EXAM_MIGRATION_BATCH_SIZE": 1000}
+        ), mock.patch(
+            "kolibri.core.logger.utils.exam_log_migration._max_query_variables",
+            return_value=2,
+        ), CaptureQueriesContext(
+            connection
+        ) as queries:
+            migrate_from_exam_logs(models.ExamLog.objects.all())
+        # The ExamAttemptLogs for the 3 ExamLogs are read 2 ExamLog ids at a time
+        self.assertEqual(
+            len(
+                [
+                    query
+                    for query in queries.captured_queries
+                    if query["sql"].startswith("SELECT")
+                    and 'FROM "logger_examattemptlog"' in query["sql"]
+                ]
+            ),
+            2,
+        )
+        self.assertEqual(models.MasteryLog.objects.all().count(), 3)
+        self.assertEqual(models.AttemptLog.objects.all().count(), 12)
+
+
 class RepeatedForwardMigrateTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -130,6 +223,57 @@ class RepeatedForwardMigrateTestCase(TestCase):
         )
 
 
+class NewAttemptsForwardMigrateTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.facility = FacilityFactory.create()
+        coach = FacilityUserFactory.create(facility=cls.facility)
+        cls.exam = Exam.objects.create(
+            title="quiz", question_count=5, collection=cls.facility, creator=coach
+        )
+        for i in range(0, 3):
+            user = FacilityUserFactory.create(facility=cls.facility)
+            models.ExamLog.objects.create(user=user, exam=cls.exam)
+
+        migrate_from_exam_logs(models.ExamLog.objects.all())
+        for examlog in models.ExamLog.objects.all():
+            for j in range(0, 4):
+                models.ExamAttemptLog.objects.create(
+                    item=str(j),
+                    user=examlog.user,
+                    examlog=examlog,
+                    start_timestamp=now(),
+                    end_timestamp=now(),
+                    correct=j % 2,
+                    content_id=uuid4().hex,
+                )
+        migrate_from_exam_logs(models.ExamLog.objects.all())
+
+    def test_attemptlogs(self):
+        self.assertEqual(models.AttemptLog.objects.all().count(), 12)
+        for attempt in models.AttemptLog.objects.all():
+            self.assertEqual(attempt.sessionlog.user_id, attempt.masterylog.user_id)
+            self.assertEqual(
+                attempt.sessionlog.content_id, attempt.masterylog.summarylog.content_id
+            )
+
+    def test_contentsessionlogs(self):
+        self.assertEqual(
+            models.ContentSessionLog.objects.all().count(),
+            3,
+        )
+
+    def test_update_session_logs_ids(self):
+        # The mastery logs that the new attempts were added to had no attempts,
+        # so their session logs are looked up by (user_id, content_id) from
+        # the session log update, which must use the same hex string ids.
+        session_logs = list(models.ContentSessionLog.objects.all())
+        self.assertEqual(
+            _update_session_logs(session_logs),
+            {(log.user_id, log.content_id): log.id for log in session_logs},
+        )
+
+
 class UpdatedForwardMigrateTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -154,7 +298,10 @@ class UpdatedForwardMigrateTestCase(TestCase):
                 )
 
         migrate_from_exam_logs(models.ExamLog.objects.all())
-        models.ExamLog.objects.all().update(closed=True)
+        cls.completion_timestamp = now()
+        models.ExamLog.objects.all().update(
+            closed=True, completion_timestamp=cls.completion_timestamp
+        )
         for examlog in models.ExamLog.objects.all():
             oldattempt = examlog.attemptlogs.first()
             oldattempt.end_timestamp = now() + timedelta(hours=1)
@@ -177,11 +324,16 @@ class UpdatedForwardMigrateTestCase(TestCase):
                 correct=0,
                 content_id=uuid4().hex,
             )
-        migrate_from_exam_logs(models.ExamLog.objects.all())
+        with CaptureQueriesContext(connection) as queries:
+            migrate_from_exam_logs(models.ExamLog.objects.all())
+        cls.queries = queries.captured_queries
 
     def test_masterylogs(self):
         self.assertEqual(models.MasteryLog.objects.all().count(), 3)
         self.assertEqual(models.MasteryLog.objects.filter(complete=True).count(), 3)
+        for log in models.MasteryLog.objects.all():
+            self.assertEqual(log.completion_timestamp, self.completion_timestamp)
+            self.assertEqual(log.end_timestamp, self.completion_timestamp)
 
     def test_attemptlogs(self):
         self.assertEqual(models.AttemptLog.objects.all().count(), 15)
@@ -197,6 +349,16 @@ class UpdatedForwardMigrateTestCase(TestCase):
         )
         self.assertEqual(unmodified_attempts.count(), 0)
 
+    def test_attemptlogs_updated_in_bulk(self):
+        attemptlog_updates = [
+            query
+            for query in self.queries
+            if query["sql"].startswith(
+                'UPDATE "{}"'.format(models.AttemptLog._meta.db_table)
+            )
+        ]
+        self.assertEqual(len(attemptlog_updates), 1)
+
     def test_contentsessionlogs(self):
         self.assertEqual(
             models.ContentSessionLog.objects.all().count(),
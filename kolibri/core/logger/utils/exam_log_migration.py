@@ -1,11 +1,12 @@
-from itertools import compress
-from itertools import groupby
+from collections import defaultdict
+from uuid import uuid4
 
 from django.db import connections
+from django.db import transaction
+from django.db.models import Case
 from django.db.models import F
-from django.db.models import FieldDoesNotExist
 from django.db.models import Value
-from django.db.models.functions import Greatest
+from django.db.models import When
 from le_utils.constants import content_kinds
 from morango.sync.backends.utils import calculate_max_sqlite_variables
 
@@ -14,42 +15,253 @@ from kolibri.core.logger.models import ContentSessionLog
 from kolibri.core.logger.models import ContentSummaryLog
 from kolibri.core.logger.models import ExamAttemptLog
 from kolibri.core.logger.models import MasteryLog
+from kolibri.utils.conf import OPTIONS
+from kolibri.utils.lru_cache import lru_cache
 from kolibri.utils.time_utils import local_now
 
 
-def _bulk_create(LogModel, logs):
-    batch_size = (
-        calculate_max_sqlite_variables() // len(LogModel._meta.fields)
-        if connections[LogModel.objects.db].vendor == "sqlite"
-        else 750
+# The maximum number of variables allowed in a single query for each
+# database vendor, for SQLite this is read from its compile options.
+# Postgres' wire protocol limits a query to 65535 parameters.
+MAX_QUERY_VARIABLES = {"postgresql": 65535}
+
+# The maximum number of rows to insert or update in a single query
+# for each database vendor, beyond which larger queries give little
+# benefit. For SQLite, bulk inserts are done with a compound SELECT,
+# which is limited to 500 terms by default, so we cannot go above that
+# without causing an OperationalError: too many terms in compound SELECT
+MAX_BATCH_SIZE = {"postgresql": 10000, "sqlite": 500}
+
+DEFAULT_MAX_QUERY_VARIABLES = 10000
+
+DEFAULT_MAX_BATCH_SIZE = 750
+
+# The number of fields on each of the models that we bulk create,
+# so that we do not have to recount them for every batch.
+log_model_field_counts = {
+    LogModel: len(LogModel._meta.fields)
+    for LogModel in (ContentSessionLog, ContentSummaryLog, MasteryLog, AttemptLog)
+}
+
+
+@lru_cache()
+def _max_sqlite_variables():
+    # This is fixed when SQLite is compiled, so only read it once,
+    # rather than opening a new connection to check it for every query.
+    return calculate_max_sqlite_variables()
+
+
+def _max_query_variables(LogModel):
+    vendor = connections[LogModel.objects.db].vendor
+    if vendor == "sqlite":
+        return _max_sqlite_variables()
+    return MAX_QUERY_VARIABLES.get(vendor, DEFAULT_MAX_QUERY_VARIABLES)
+
+
+def _batch_size(LogModel, variables_per_log):
+    """
+    Return how many logs can be written in a single query, when
+    each log requires the passed in number of query variables.
+    """
+    vendor = connections[LogModel.objects.db].vendor
+    return max(
+        min(
+            _max_query_variables(LogModel) // variables_per_log,
+            MAX_BATCH_SIZE.get(vendor, DEFAULT_MAX_BATCH_SIZE),
+        ),
+        1,
     )
+
+
+def _bulk_create(LogModel, logs):
+    batch_size = _batch_size(LogModel, log_model_field_counts[LogModel])
     return LogModel.objects.bulk_create(logs, batch_size=batch_size)
 
 
-def _update_session_log(log):
-    ContentSessionLog.objects.filter(content_id=log.content_id, user=log.user).update(
-        progress=Greatest("progress", Value(log.progress)),
-        end_timestamp=Greatest("end_timestamp", Value(log.end_timestamp)),
-    )
+def _bulk_update(LogModel, logs, fields):
+    """
+    Update the passed in fields on the already saved logs, using a single
+    UPDATE query with a CASE statement per field for each batch of logs,
+    rather than an UPDATE query per log.
+    """
+    fields = [LogModel._meta.get_field(field) for field in fields]
+    # Each log adds a query variable for its id in the WHERE clause,
+    # and two query variables for each field being updated.
+    batch_size = _batch_size(LogModel, 2 * len(fields) + 1)
+    for i in range(0, len(logs), batch_size):
+        batch = logs[i : i + batch_size]
+        LogModel.objects.filter(id__in=[log.id for log in batch]).update(
+            **{
+                field.attname: Case(
+                    *[
+                        When(
+                            id=log.id,
+                            then=Value(getattr(log, field.attname), output_field=field),
+                        )
+                        for log in batch
+                    ],
+                    output_field=field
+                )
+                for field in fields
+            }
+        )
 
 
-def _update_summary_log(log):
-    ContentSummaryLog.objects.filter(content_id=log.content_id, user=log.user).update(
-        progress=Greatest("progress", Value(log.progress)),
-        end_timestamp=Greatest("end_timestamp", Value(log.end_timestamp)),
-        completion_timestamp=Greatest(
-            "completion_timestamp", Value(log.completion_timestamp)
-        ),
+def _calculate_partition(dataset_id, user_id):
+    """
+    Equivalent of BaseLogModel.calculate_partition, for when we already
+    have the dataset_id and user_id, and do not need a log instance.
+    """
+    if user_id:
+        return "{dataset_id}:user-rw:{user_id}".format(
+            dataset_id=dataset_id, user_id=user_id
+        )
+    return "{dataset_id}:anonymous".format(dataset_id=dataset_id)
+
+
+def _set_uuid(log, partition, source_id=None):
+    """
+    Equivalent of setting the id of the log using its calculate_uuid method,
+    but with a partition and source id that we have already calculated, so
+    that we do not recalculate them for every log.
+    A source id of None gives a random source id, as calculate_uuid does.
+    """
+    if source_id is None:
+        source_id = uuid4().hex
+    log._morango_source_id = source_id
+    log._morango_partition = partition
+    log.id = log.compute_namespaced_id(partition, source_id, log.morango_model_name)
+
+
+def _get_pre_existing_summary_log_ids(source_logs):
+    """
+    Compute the ids of the ContentSummaryLogs that would be generated from
+    the passed in ExamLogs, and return the set of those that already exist.
+    As the summary log ids are deterministic, we can do this up front for all
+    the source logs, rather than querying for each batch that we migrate.
+    """
+    # All migrated summary logs are for quizzes, so if there are no quiz
+    # summary logs at all, as for a first time migration, none can exist.
+    if not ContentSummaryLog.objects.filter(kind=content_kinds.QUIZ).exists():
+        return set()
+    summary_log_ids = [
+        ContentSummaryLog.compute_namespaced_id(
+            _calculate_partition(dataset_id, user_id),
+            exam_id,
+            ContentSummaryLog.morango_model_name,
+        )
+        for user_id, dataset_id, exam_id in source_logs.values_list(
+            "user_id", "user__dataset_id", "exam_id"
+        ).iterator()
+    ]
+    query_size = _max_query_variables(ContentSummaryLog)
+    pre_existing_summary_log_ids = set()
+    for i in range(0, len(summary_log_ids), query_size):
+        pre_existing_summary_log_ids.update(
+            ContentSummaryLog.objects.filter(
+                id__in=summary_log_ids[i : i + query_size]
+            ).values_list("id", flat=True)
+        )
+    return pre_existing_summary_log_ids
+
+
+def _greatest(*values):
+    """
+    Python equivalent of the Greatest database function, ignoring null values,
+    as Postgres does. On SQLite, Greatest returns null if any value is null,
+    so a log with no completion_timestamp would never have been given one.
+    """
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def _get_existing_session_logs(keys):
+    """
+    Return a dict of the existing ContentSessionLogs, keyed by the passed in
+    (user_id, content_id) pairs that they match.
+    """
+    keys = list(set(keys))
+    # Each key adds two query variables, one for the user_id and one for the content_id
+    query_size = _max_query_variables(ContentSessionLog) // 2
+    existing_logs = defaultdict(list)
+    for i in range(0, len(keys), query_size):
+        batch = set(keys[i : i + query_size])
+        for existing_log in ContentSessionLog.objects.filter(
+            user_id__in=set(user_id for user_id, _ in batch),
+            content_id__in=set(content_id for _, content_id in batch),
+        ):
+            key = (existing_log.user_id, existing_log.content_id)
+            if key in batch:
+                existing_logs[key].append(existing_log)
+    return existing_logs
+
+
+def _update_session_logs(logs):
+    """
+    Update the existing ContentSessionLogs for the passed in logs, and return
+    a dict of the id of one of the existing session logs for each log, keyed
+    by their (user_id, content_id) pair.
+    """
+    existing_logs = _get_existing_session_logs(
+        (log.user_id, log.content_id) for log in logs
+    )
+    to_update = []
+    for log in logs:
+        for existing_log in existing_logs.get((log.user_id, log.content_id), []):
+            existing_log.progress = _greatest(existing_log.progress, log.progress)
+            existing_log.end_timestamp = _greatest(
+                existing_log.end_timestamp, log.end_timestamp
+            )
+            to_update.append(existing_log)
+    _bulk_update(ContentSessionLog, to_update, ["progress", "end_timestamp"])
+    return {key: session_logs[0].id for key, session_logs in existing_logs.items()}
+
+
+def _update_summary_logs(logs):
+    logs_by_id = {log.id: log for log in logs}
+    query_size = _max_query_variables(ContentSummaryLog)
+    to_update = []
+    for i in range(0, len(logs), query_size):
+        for existing_log in ContentSummaryLog.objects.filter(
+            id__in=[log.id for log in logs[i : i + query_size]]
+        ):
+            log = logs_by_id[existing_log.id]
+            existing_log.progress = _greatest(existing_log.progress, log.progress)
+            existing_log.end_timestamp = _greatest(
+                existing_log.end_timestamp, log.end_timestamp
+            )
+            existing_log.completion_timestamp = _greatest(
+                existing_log.completion_timestamp, log.completion_timestamp
+            )
+            to_update.append(existing_log)
+    _bulk_update(
+        ContentSummaryLog,
+        to_update,
+        ["progress", "end_timestamp", "completion_timestamp"],
     )
 
 
-def _update_mastery_log(log):
-    MasteryLog.objects.filter(summarylog_id=log.summarylog_id, user=log.user).update(
-        complete=Greatest("complete", Value(log.complete)),
-        end_timestamp=Greatest("end_timestamp", Value(log.end_timestamp)),
-        completion_timestamp=Greatest(
-            "completion_timestamp", Value(log.completion_timestamp)
-        ),
+def _update_mastery_logs(logs):
+    logs_by_summarylog_id = {log.summarylog_id: log for log in logs}
+    query_size = _max_query_variables(MasteryLog)
+    to_update = []
+    for i in range(0, len(logs), query_size):
+        for existing_log in MasteryLog.objects.filter(
+            summarylog_id__in=[log.summarylog_id for log in logs[i : i + query_size]]
+        ):
+            log = logs_by_summarylog_id[existing_log.summarylog_id]
+            if existing_log.user_id != log.user_id:
+                continue
+            existing_log.complete = _greatest(existing_log.complete, log.complete)
+            existing_log.end_timestamp = _greatest(
+                existing_log.end_timestamp, log.end_timestamp
+            )
+            existing_log.completion_timestamp = _greatest(
+                existing_log.completion_timestamp, log.completion_timestamp
+            )
+            to_update.append(existing_log)
+    _bulk_update(
+        MasteryLog, to_update, ["complete", "end_timestamp", "completion_timestamp"]
     )
 
 
@@ -69,50 +281,56 @@ attempt_log_fields_for_update = [
     "error",
 ]
 
-
-BATCH_READ_SIZE = 750
-
 # Things that we will set as constant for every examlog we migrate
 kind = content_kinds.QUIZ
 mastery_criterion = {"type": content_kinds.QUIZ, "coach_assigned": True}
 
 
-def _update_attempt_logs(masterylog_id, logs):
-    existing_logs = AttemptLog.objects.filter(masterylog_id=masterylog_id)
-    existing_log_items = {log.item: log for log in existing_logs}
+def _update_attempt_logs(logs, fallback_sessionlog_ids):
+    """
+    Merge the passed in AttemptLogs with any existing AttemptLogs for the
+    same masterylog and item, creating any that do not already exist.
+    Existing AttemptLogs for all the masterylogs are fetched in one go,
+    and updated and created in bulk.
+    New AttemptLogs are given the same sessionlog as the existing AttemptLogs
+    for their masterylog, or if there are none, the sessionlog id for their
+    masterylog in fallback_sessionlog_ids.
+    """
+    masterylog_ids = list(set(log.masterylog_id for log in logs))
+    existing_log_items = {}
+    sessionlog_ids = {}
+    query_size = _max_query_variables(AttemptLog)
+    for i in range(0, len(masterylog_ids), query_size):
+        # Only read the values we need to merge the logs, rather than
+        # fetching every column to create full AttemptLog instances.
+        existing_logs = AttemptLog.objects.filter(
+            masterylog_id__in=masterylog_ids[i : i + query_size]
+        ).values_list("id", "masterylog_id", "item", "sessionlog_id", "end_timestamp")
+        for log_id, masterylog_id, item, sessionlog_id, end_timestamp in existing_logs:
+            existing_log_items[(masterylog_id, item)] = (log_id, end_timestamp)
+            sessionlog_ids.setdefault(masterylog_id, sessionlog_id)
     to_create = []
-    if existing_logs:
-        sessionlog_id = existing_logs[0].sessionlog_id
-    else:
-        content_id = (
-            MasteryLog.objects.filter(id=masterylog_id)
-            .values_list("summarylog__content_id", flat=True)
-            .first()
-        )
-        sessionlog_id = (
-            ContentSessionLog.objects.filter(content_id=content_id)
-            .values_list("id", flat=True)
-            .first()
-        )
+    to_update = {}
     for log in logs:
-        if log.item in existing_log_items:
-            existing_log = existing_log_items[log.item]
+        key = (log.masterylog_id, log.item)
+        if key in existing_log_items:
+            existing_log_id, existing_end_timestamp = existing_log_items[key]
             # Last write wins
             # Otherwise we ignore the updated log.
-            # Need to cast the value for the unsaved log here, as otherwise
-            # it is still in the string form, rather than datetime, as Morango
-            # deserialize does not run to_python_value or from_db_value.
-            if existing_log.end_timestamp < log.end_timestamp:
-                for field in attempt_log_fields_for_update:
-                    setattr(
-                        existing_log,
-                        field,
-                        getattr(log, field, getattr(existing_log, field)),
-                    )
-                existing_log.save()
+            # Both end_timestamps are datetimes here, as the values
+            # we create AttemptLogs from are already in their Python form.
+            if existing_end_timestamp < log.end_timestamp:
+                # Give the log the id of the existing AttemptLog, so that
+                # its fields are written onto the existing AttemptLog.
+                log.id = existing_log_id
+                existing_log_items[key] = (existing_log_id, log.end_timestamp)
+                to_update[existing_log_id] = log
         else:
-            log.sessionlog_id = sessionlog_id
+            log.sessionlog_id = sessionlog_ids.get(
+                log.masterylog_id, fallback_sessionlog_ids.get(log.masterylog_id)
+            )
             to_create.append(log)
+    _bulk_update(AttemptLog, list(to_update.values()), attempt_log_fields_for_update)
     _bulk_create(AttemptLog, to_create)
 
 
@@ -128,40 +346,90 @@ exam_attempts_blocklist = {
 }
 
 
+# The ExamAttemptLog fields that are copied as is onto the new AttemptLog,
+# derived from the AttemptLog fields, so that any field added to both
+# models is migrated without having to be listed here.
+attempt_log_fields_to_copy = [
+    field.attname
+    for field in AttemptLog._meta.concrete_fields
+    if field.attname not in exam_attempts_blocklist
+    and field.attname not in ("sessionlog_id", "masterylog_id")
+]
+
+# ExamAttemptLog fields that we need to read in order to
+# create the new AttemptLog, so that we do not load the columns
+# in the blocklist above that we do not use
+exam_attempt_fields_to_load = ("id", "examlog_id", "content_id") + tuple(
+    attempt_log_fields_to_copy
+)
+
+# ExamLog fields that we need to read in order to create the
+# new ContentSessionLog, ContentSummaryLog and MasteryLog
+exam_fields_to_load = (
+    "id",
+    "exam_id",
+    "closed",
+    "completion_timestamp",
+    "user_id",
+    "user__dataset_id",
+)
+
+
 def _create_attemptlog(examattemptlog, sessionlog_id, masterylog_id):
-    data = examattemptlog.serialize()
-    attemptlog = AttemptLog()
-    for field, value in data.items():
-        if field not in exam_attempts_blocklist:
-            try:
-                field_obj = AttemptLog._meta.get_field(field)
-                if hasattr(field_obj, "from_db_value"):
-                    value = field_obj.from_db_value(value, None, None, None)
-            except FieldDoesNotExist:
-                pass
-            setattr(attemptlog, field, value)
-    attemptlog.sessionlog_id = sessionlog_id
-    attemptlog.masterylog_id = masterylog_id
-    attemptlog.item = "{}:{}".format(examattemptlog.content_id, attemptlog.item)
-    attemptlog.id = attemptlog.calculate_uuid()
+    """
+    Create an AttemptLog from a dict of the values of an ExamAttemptLog,
+    as returned by a values query for exam_attempt_fields_to_load.
+    These values have already been converted from their database form
+    to their Python form by the query, so can be copied across as is.
+    """
+    kwargs = {field: examattemptlog[field] for field in attempt_log_fields_to_copy}
+    kwargs["sessionlog_id"] = sessionlog_id
+    kwargs["masterylog_id"] = masterylog_id
+    kwargs["item"] = "{}:{}".format(examattemptlog["content_id"], kwargs["item"])
+    attemptlog = AttemptLog(**kwargs)
+    _set_uuid(attemptlog, _calculate_partition(kwargs["dataset_id"], kwargs["user_id"]))
     return attemptlog
 
 
-def _handle_examlog(examlog, unprocessed_attempt_log_ids):
-    examattemptlogs = examlog.attemptlogs.all()
-    try:
-        start_timestamp = min(e.start_timestamp for e in examattemptlogs)
-    except ValueError:
+def _get_examattemptlogs(examlog_ids):
+    """
+    Return a dict of lists of the values of the ExamAttemptLogs
+    for the passed in ExamLog ids, keyed by ExamLog id, with each
+    list ordered by start_timestamp.
+    """
+    examattemptlogs = defaultdict(list)
+    query_size = _max_query_variables(ExamAttemptLog)
+    # All the ExamAttemptLogs for an ExamLog are read in the same query,
+    # so each list is still ordered by start_timestamp.
+    for i in range(0, len(examlog_ids), query_size):
+        for examattemptlog in (
+            ExamAttemptLog.objects.filter(
+                examlog_id__in=examlog_ids[i : i + query_size]
+            )
+            .order_by("start_timestamp")
+            .values(*exam_attempt_fields_to_load)
+        ):
+            examattemptlogs[examattemptlog["examlog_id"]].append(examattemptlog)
+    return examattemptlogs
+
+
+def _handle_examlog(examlog, examattemptlogs, unprocessed_attempt_log_ids):
+    # Ordered by start_timestamp, so the first is the earliest
+    if examattemptlogs:
+        start_timestamp = examattemptlogs[0]["start_timestamp"]
+    else:
         start_timestamp = local_now()
-    content_id = examlog.exam_id
-    user = examlog.user
-    complete = examlog.closed
-    progress = 1 if examlog.closed else 0
-    completion_timestamp = examlog.completion_timestamp
-    end_timestamp = examlog.completion_timestamp
-    dataset_id = user.dataset_id
+    content_id = examlog["exam_id"]
+    user_id = examlog["user_id"]
+    complete = examlog["closed"]
+    progress = 1 if examlog["closed"] else 0
+    completion_timestamp = examlog["completion_timestamp"]
+    end_timestamp = examlog["completion_timestamp"]
+    dataset_id = examlog["user__dataset_id"]
+    # All the logs for this examlog are in the same partition, so only calculate it once
+    partition = _calculate_partition(dataset_id, user_id)
     session_log = ContentSessionLog(
-        user=user,
+        user_id=user_id,
         content_id=content_id,
         start_timestamp=start_timestamp,
         end_timestamp=end_timestamp,
@@ -169,10 +437,10 @@ def _handle_examlog(examlog, unprocessed_attempt_log_ids):
         kind=kind,
         dataset_id=dataset_id,
     )
-    session_log.id = session_log.calculate_uuid()
+    _set_uuid(session_log, partition)
 
     summary_log = ContentSummaryLog(
-        user=user,
+        user_id=user_id,
         content_id=content_id,
         start_timestamp=start_timestamp,
         end_timestamp=end_timestamp,
@@ -181,10 +449,10 @@ def _handle_examlog(examlog, unprocessed_attempt_log_ids):
         kind=kind,
         dataset_id=dataset_id,
     )
-    summary_log.id = summary_log.calculate_uuid()
+    _set_uuid(summary_log, partition, content_id)
 
     mastery_log = MasteryLog(
-        user=user,
+        user_id=user_id,
         summarylog_id=summary_log.id,
         mastery_criterion=mastery_criterion,
         start_timestamp=start_timestamp,
@@ -192,11 +460,19 @@ def _handle_examlog(examlog, unprocessed_attempt_log_ids):
         completion_timestamp=completion_timestamp,
         # Do this rather than just generating a random value
         # so that the mastery log id is deterministic.
-        mastery_level=int(str(int(content_id, 16))[-9:]),
+        # This is the last 9 decimal digits of the integer value of the exam_id.
+        mastery_level=int(content_id, 16) % 1000000000,
         complete=complete,
         dataset_id=dataset_id,
     )
-    mastery_log.id = mastery_log.calculate_uuid()
+    _set_uuid(
+        mastery_log,
+        partition,
+        "{summarylog_id}:{mastery_level}".format(
+            summarylog_id=mastery_log.summarylog_id,
+            mastery_level=mastery_log.mastery_level,
+        ),
+    )
 
     attempt_logs = []
 
@@ -204,46 +480,54 @@ def _handle_examlog(examlog, unprocessed_attempt_log_ids):
         attemptlog = _create_attemptlog(examattemptlog, session_log.id, mastery_log.id)
         attempt_logs.append(attemptlog)
         try:
-            unprocessed_attempt_log_ids.remove(examattemptlog.id)
+            unprocessed_attempt_log_ids.remove(examattemptlog["id"])
         except KeyError:
             pass
     return session_log, summary_log, mastery_log, attempt_logs
 
 
-def _handle_unprocessed_attemptlog_ids(unprocessed_attempt_log_ids):
+def _handle_unprocessed_attemptlog_ids(unprocessed_attempt_log_ids, batch_size):
     if unprocessed_attempt_log_ids:
         examlog_id_to_masterylog = {}
+        masterylog_id_to_session_key = {}
         unprocessed_attempt_log_ids = list(unprocessed_attempt_log_ids)
         attempt_logs = []
-        i = 0
-        source_logs = ExamAttemptLog.objects.filter(
-            id__in=unprocessed_attempt_log_ids[i : i + BATCH_READ_SIZE]
-        ).annotate(exam_id=F("examlog__exam_id"))
-        while source_logs:
+        query_size = min(batch_size, _max_query_variables(ExamAttemptLog))
+        for i in range(0, len(unprocessed_attempt_log_ids), query_size):
+            source_logs = ExamAttemptLog.objects.filter(
+                id__in=unprocessed_attempt_log_ids[i : i + query_size]
+            ).values(*exam_attempt_fields_to_load, exam_id=F("examlog__exam_id"))
             for examattemptlog in source_logs:
-                if examattemptlog.examlog_id not in examlog_id_to_masterylog:
-                    examlog_id_to_masterylog[examattemptlog.examlog_id] = (
+                if examattemptlog["examlog_id"] not in examlog_id_to_masterylog:
+                    examlog_id_to_masterylog[examattemptlog["examlog_id"]] = (
                         MasteryLog.objects.filter(
-                            user_id=examattemptlog.user_id,
-                            summarylog__content_id=examattemptlog.exam_id,
+                            user_id=examattemptlog["user_id"],
+                            summarylog__content_id=examattemptlog["exam_id"],
                         )
                         .values_list("id", flat=True)
                         .first()
                     )
-                masterylog_id = examlog_id_to_masterylog[examattemptlog.examlog_id]
+                masterylog_id = examlog_id_to_masterylog[examattemptlog["examlog_id"]]
                 if masterylog_id:
+                    masterylog_id_to_session_key[masterylog_id] = (
+                        examattemptlog["user_id"],
+                        examattemptlog["exam_id"],
+                    )
                     attemptlog = _create_attemptlog(examattemptlog, None, masterylog_id)
                     attempt_logs.append(attemptlog)
-            i += BATCH_READ_SIZE
-            source_logs = ExamAttemptLog.objects.filter(
-                id__in=unprocessed_attempt_log_ids[i : i + BATCH_READ_SIZE]
-            ).annotate(exam_id=F("examlog__exam_id"))
 
-        for masterylog_id, logs in groupby(
-            sorted(attempt_logs, key=lambda x: x.masterylog_id),
-            lambda x: x.masterylog_id,
-        ):
-            _update_attempt_logs(masterylog_id, logs)
+        existing_session_logs = _get_existing_session_logs(
+            masterylog_id_to_session_key.values()
+        )
+        with transaction.atomic():
+            _update_attempt_logs(
+                attempt_logs,
+                {
+                    masterylog_id: existing_session_logs[key][0].id
+                    for masterylog_id, key in masterylog_id_to_session_key.items()
+                    if key in existing_session_logs
+                },
+            )
 
 
 def migrate_from_exam_logs(source_logs, source_attempt_log_ids=None):  # noqa C901
@@ -302,56 +586,62 @@ def migrate_from_exam_logs(source_logs, source_attempt_log_ids=None):  # noqa C9
         set() if source_attempt_log_ids is None else set(source_attempt_log_ids)
     )
 
-    source_logs = source_logs.prefetch_related("attemptlogs")
+    pre_existing_summary_logs = _get_pre_existing_summary_log_ids(source_logs)
 
-    i = 0
+    # Read at least one log at a time, as no logs would be migrated otherwise.
+    batch_size = max(1, OPTIONS["Database"]["EXAM_MIGRATION_BATCH_SIZE"])
 
-    logs = source_logs[i : i + BATCH_READ_SIZE]
+    # Page through the source logs by id, rather than by offset, so that
+    # reading each batch does not get slower the further through we are.
+    source_logs = source_logs.order_by("id").values(*exam_fields_to_load)
+
+    logs = list(source_logs[:batch_size])
 
     while logs:
-        content_session_logs = []
-        content_summary_logs = []
-        mastery_logs = []
-        attempt_logs = []
-        summary_log_ids = []
+        # Partition the logs for each examlog, depending on whether they
+        # have been migrated before, and so need creating or updating.
+        new_logs = []
+        existing_logs = []
+        new_attempt_logs = []
+        existing_attempt_logs = []
+        examattemptlogs = _get_examattemptlogs([examlog["id"] for examlog in logs])
         for examlog in logs:
             session_log, summary_log, mastery_log, attempts = _handle_examlog(
-                examlog, unprocessed_attempt_log_ids
+                examlog, examattemptlogs[examlog["id"]], unprocessed_attempt_log_ids
             )
-            content_session_logs.append(session_log)
-            content_summary_logs.append(summary_log)
-            summary_log_ids.append(summary_log.id)
-            mastery_logs.append(mastery_log)
-            attempt_logs.extend(attempts)
-
-        pre_existing_summary_logs = set(
-            ContentSummaryLog.objects.filter(id__in=summary_log_ids).values_list(
-                "id", flat=True
+            if summary_log.id in pre_existing_summary_logs:
+                existing_logs.append((session_log, summary_log, mastery_log))
+                existing_attempt_logs.extend(attempts)
+            else:
+                new_logs.append((session_log, summary_log, mastery_log))
+                new_attempt_logs.extend(attempts)
+
+        # Do all the writes for each batch in a single transaction,
+        # rather than committing after every query.
+        with transaction.atomic():
+            _bulk_create(
+                ContentSessionLog, [session_log for session_log, _, _ in new_logs]
             )
-        )
-        mask = [log.id not in pre_existing_summary_logs for log in content_summary_logs]
-        inverse_mask = [not m for m in mask]
-        _bulk_create(ContentSessionLog, compress(content_session_logs, mask))
-        _bulk_create(ContentSummaryLog, compress(content_summary_logs, mask))
-
-        masked_masterylogs = list(compress(mastery_logs, mask))
-        written_masterylog_ids = set(m.id for m in masked_masterylogs)
-        _bulk_create(MasteryLog, masked_masterylogs)
-        _bulk_create(
-            AttemptLog,
-            filter(lambda x: x.masterylog_id in written_masterylog_ids, attempt_logs),
-        )
+            _bulk_create(
+                ContentSummaryLog, [summary_log for _, summary_log, _ in new_logs]
+            )
+            _bulk_create(MasteryLog, [mastery_log for _, _, mastery_log in new_logs])
+            _bulk_create(AttemptLog, new_attempt_logs)
+
+            existing_session_log_ids = _update_session_logs(
+                [session_log for session_log, _, _ in existing_logs]
+            )
+            _update_summary_logs([summary_log for _, summary_log, _ in existing_logs])
+            _update_mastery_logs([mastery_log for _, _, mastery_log in existing_logs])
+            _update_attempt_logs(
+                existing_attempt_logs,
+                {
+                    mastery_log.id: existing_session_log_ids.get(
+                        (session_log.user_id, session_log.content_id)
+                    )
+                    for session_log, _, mastery_log in existing_logs
+                },
+            )
+        logs = list(source_logs.filter(id__gt=logs[-1]["id"])[:batch_size])
 
-        for log in compress(content_session_logs, inverse_mask):
-            _update_session_log(log)
-        for log in compress(content_summary_logs, inverse_mask):
-            _update_summary_log(log)
-        for log in compress(mastery_logs, inverse_mask):
-            _update_mastery_log(log)
-        for masterylog_id, logs in groupby(attempt_logs, lambda x: x.masterylog_id):
-            if masterylog_id not in written_masterylog_ids:
-                _update_attempt_logs(masterylog_id, logs)
-        i += BATCH_READ_SIZE
-        logs = source_logs[i : i + BATCH_READ_SIZE]
-
-    _handle_unprocessed_attemptlog_ids(unprocessed_attempt_log_ids)
+    _handle_unprocessed_attemptlog_ids(unprocessed_attempt_log_ids, batch_size)
@@ -321,6 +321,14 @@ base_option_spec = {
             "type": "string",
             "description": "The port on which to connect to the database, Postgresql only.",
         },
+        "EXAM_MIGRATION_BATCH_SIZE": {
+            "type": "integer",
+            "default": 750,
+            "description": """
+                How many ExamLogs to read at a time when migrating them to the new quiz logging format.
+                Values below 1 are treated as 1.
+            """,
+        },
     },
     "Server": {
         "CHERRYPY_START": {